@@ -1,14 +1,27 @@
 import os, time, requests, json
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 class CatalogClient:
     """Lightweight client with cache; supports full catalog GET and focused user endpoints."""
     def __init__(self, url: str | None = None, ttl: float = 5.0, timeout: float = 5.0, write_token: str | None = None):
         self.url = url or os.getenv("CATALOG_URL", "http://catalog:9080/catalog")
         self.ttl = ttl
-        self.timeout = timeout
+        # (connect, read) timeout tuple: fail fast on an unreachable catalog,
+        # allow slower bodies once connected.
+        self.timeout = timeout if isinstance(timeout, tuple) else (2, timeout)
         self.write_token = write_token or os.getenv("CATALOG_WRITE_TOKEN")
         self._cache = None
         self._last = 0.0
+        # Pooled keep-alive session: callers poll the same host repeatedly,
+        # so reusing sockets avoids a TCP handshake per request.
+        self.s = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=4, pool_maxsize=16,
+            max_retries=Retry(total=2, backoff_factor=0.2,
+                              status_forcelist=(502, 503, 504)))
+        self.s.mount("http://", adapter)
+        self.s.mount("https://", adapter)
 
     def _base_url(self) -> str:
         base = self.url.rstrip("/")
@@ -26,7 +39,7 @@ class CatalogClient:
         target = self.url
         if not target.rstrip("/").endswith("/catalog"):
             target = f"{self._base_url()}/catalog"
-        r = requests.get(target, timeout=self.timeout)
+        r = self.s.get(target, timeout=self.timeout)
         r.raise_for_status()
         return r.json()
 
@@ -41,6 +54,11 @@ class CatalogClient:
         """Alias for get(); returns the full catalog document."""
         return self.get(force=force)
 
+    def snapshot(self, force: bool = False) -> dict:
+        """Single cached /catalog fetch; one round-trip serves usersList,
+        roomsList and thresholds instead of separate focused GETs."""
+        return self.get(force=force)
+
     # -------- helpers de negocio --------
     def broker(self) -> tuple[str, int]:
         c = self.get()
@@ -74,7 +92,7 @@ class CatalogClient:
         GET /users/{user_id}. Returns None on 404.
         """
         url = f"{self._base_url()}/users/{user_id}"
-        r = requests.get(url, timeout=self.timeout)
+        r = self.s.get(url, timeout=self.timeout)
         if r.status_code == 404:
             return None
         r.raise_for_status()
@@ -83,21 +101,21 @@ class CatalogClient:
     def get_users(self) -> list:
         """GET /users."""
         url = f"{self._base_url()}/users"
-        r = requests.get(url, timeout=self.timeout)
+        r = self.s.get(url, timeout=self.timeout)
         r.raise_for_status()
         return r.json()
 
     def get_rooms(self) -> list:
         """GET /rooms."""
         url = f"{self._base_url()}/rooms"
-        r = requests.get(url, timeout=self.timeout)
+        r = self.s.get(url, timeout=self.timeout)
         r.raise_for_status()
         return r.json()
 
     def get_room(self, room_id: str) -> dict | None:
         """GET /rooms/{room_id}. Returns None on 404."""
         url = f"{self._base_url()}/rooms/{room_id}"
-        r = requests.get(url, timeout=self.timeout)
+        r = self.s.get(url, timeout=self.timeout)
         if r.status_code == 404:
             return None
         r.raise_for_status()
@@ -117,7 +135,7 @@ class CatalogClient:
         PATCH /users/{user_id} with given payload.
         """
         url = f"{self._base_url()}/users/{user_id}"
-        r = requests.patch(url, data=json.dumps(patch), headers=self._headers(), timeout=self.timeout)
+        r = self.s.patch(url, data=json.dumps(patch), headers=self._headers(), timeout=self.timeout)
         r.raise_for_status()
         return r.json()
 
@@ -126,7 +144,7 @@ class CatalogClient:
         PATCH /services/{service_id} with given payload.
         """
         url = f"{self._base_url()}/services/{service_id}"
-        r = requests.patch(url, data=json.dumps(patch), headers=self._headers(), timeout=self.timeout)
+        r = self.s.patch(url, data=json.dumps(patch), headers=self._headers(), timeout=self.timeout)
         r.raise_for_status()
         return r.json()
 
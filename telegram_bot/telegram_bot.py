@@ -1,17 +1,24 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import asyncio
 import json
 import base64
 import logging
+import os
 import re
-import threading
 import time
 from dataclasses import dataclass
 from typing import Optional, Dict, Any, Set, List
 
-import requests
-from paho.mqtt.client import Client as MqttClient, MQTTMessage
+import orjson
+import aiomqtt
+from paho.mqtt.client import Client as MqttClient  # publisher only
+
+try:  # optional: shared/persistent sessions (REDIS_URL)
+    import redis
+except Exception:
+    redis = None
 from common.catalog_client import CatalogClient
 
 from telegram import (
@@ -27,6 +34,11 @@ from telegram.ext import (
     filters,
 )
 
+try:  # needs the python-telegram-bot[rate-limiter] extra
+    from telegram.ext import AIORateLimiter
+except Exception:
+    AIORateLimiter = None
+
 # ---------------- Logging ----------------
 logging.basicConfig(
     level=logging.INFO,
@@ -35,7 +47,7 @@ logging.basicConfig(
 log = logging.getLogger("telegrambot")
 
 # ---------------- Settings ----------------
-@dataclass
+@dataclass(slots=True)
 class BotSettings:
     catalog_url: str        # e.g. http://catalog:9080/catalog (can include /catalog)
     broker_ip: str          # MQTT host
@@ -79,11 +91,59 @@ PHONE_RE = re.compile(r"^\+?\d{7,15}$")
 TIME_RE  = re.compile(r"^([01]\d|2[0-3]):([0-5]\d)$")
 NUM_RE   = re.compile(r"^-?\d+(\.\d+)?$")
 
+# Callers pass text already stripped, so no re-strip/allocation here.
 def ok_num(s: str) -> bool:
-    return bool(NUM_RE.match((s or "").strip()))
+    return s is not None and NUM_RE.match(s) is not None
 
 def ok_time(s: str) -> bool:
-    return bool(TIME_RE.match((s or "").strip()))
+    return s is not None and TIME_RE.match(s) is not None
+
+# ---------------- Session storage ----------------
+class SessionStore:
+    """Verified-session storage: chat -> user and user -> chats routing.
+
+    With REDIS_URL set (and the redis package installed) sessions live in
+    Redis with a TTL, so they survive bot restarts and can be shared by
+    several bot replicas behind one MQTT subscriber. Without it, behavior
+    falls back to the original in-process dicts.
+    """
+    SESSION_TTL = 86400  # 1 day
+
+    def __init__(self, url: Optional[str] = None):
+        self.r = None
+        if url and redis is not None:
+            try:
+                self.r = redis.Redis.from_url(url, decode_responses=True)
+                self.r.ping()
+            except Exception:
+                log.exception("Redis unavailable at %s; using in-process sessions", url)
+                self.r = None
+        # chat_id -> user_id
+        self._session_by_chat: Dict[int, str] = {}
+        # user_id -> set(chat_id)
+        self._chats_by_user: Dict[str, Set[int]] = {}
+
+    def open_session(self, chat_id: int, user_id: str):
+        if self.r is not None:
+            p = self.r.pipeline()
+            p.set(f"sess:{chat_id}", user_id, ex=self.SESSION_TTL)
+            p.sadd(f"user_chats:{user_id}", chat_id)
+            p.expire(f"user_chats:{user_id}", self.SESSION_TTL)
+            p.execute()
+            return
+        self._session_by_chat[chat_id] = user_id
+        self._chats_by_user.setdefault(user_id, set()).add(chat_id)
+
+    def user_for_chat(self, chat_id: int) -> Optional[str]:
+        if self.r is not None:
+            return self.r.get(f"sess:{chat_id}")
+        return self._session_by_chat.get(chat_id)
+
+    def chats_for_user(self, user_id: str) -> Set[int]:
+        if self.r is not None:
+            return {int(c) for c in self.r.smembers(f"user_chats:{user_id}")}
+        return self._chats_by_user.get(user_id, set())
+
 
 # ---------------- TelegramBot Service ----------------
 class TelegramBotService:
@@ -93,13 +153,14 @@ class TelegramBotService:
     - Configure times & thresholds (writes back to Catalog)
     - Track verified sessions to route MQTT alerts and bedtime/wakeup notifications
     """
+    __slots__ = ("S", "cat", "sessions", "tmp", "application",
+                 "mqtt_pub", "_user_cache", "_user_cache_ttl")
+
     def __init__(self, settings: BotSettings):
         self.S = settings
         self.cat = CatalogClient(url=self.S.catalog_url)
-        # chat_id -> user_id
-        self.session_by_chat: Dict[int, str] = {}
-        # user_id -> set(chat_id)
-        self.chats_by_user: Dict[str, Set[int]] = {}
+        # Verified sessions (Redis-backed when REDIS_URL is set)
+        self.sessions = SessionStore(os.getenv("REDIS_URL"))
         # temp data per chat
         self.tmp: Dict[int, Dict[str, Any]] = {}
         # PTB application (set in build_app)
@@ -115,6 +176,22 @@ class TelegramBotService:
         self.mqtt_pub = MqttClient(client_id=f"telegram-pub-{self.S.service_id}", clean_session=True)
         self.mqtt_pub.connect(self.S.broker_ip, self.S.broker_port, keepalive=30)
         self.mqtt_pub.loop_start()
+        # Short-lived user cache; menu flows re-read the same user repeatedly
+        self._user_cache: Dict[str, tuple] = {}
+        self._user_cache_ttl = 60.0
+
+    # ---- Catalog helpers ----
+    def _get_user_cached(self, user_id: str) -> Optional[Dict[str, Any]]:
+        now = time.monotonic()
+        hit = self._user_cache.get(user_id)
+        if hit and now - hit[0] < self._user_cache_ttl:
+            return hit[1]
+        user = self.cat.get_user(user_id)
+        self._user_cache[user_id] = (now, user)
+        return user
+
+    def _invalidate_user(self, user_id: str):
+        self._user_cache.pop(user_id, None)
 
     # ---- Telegram Handlers ----
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -204,8 +281,7 @@ class TelegramBotService:
             return ASK_PASSWORD
 
         # Success: open session
-        self.session_by_chat[chat_id] = user_id
-        self.chats_by_user.setdefault(user_id, set()).add(chat_id)
+        self.sessions.open_session(chat_id, user_id)
         uname = user.get("user_information", {}).get("userName", user_id)
         await update.message.reply_text(
             f"✅ Logged in as *{uname}* (`{user_id}`). Choose an option:",
@@ -221,12 +297,12 @@ class TelegramBotService:
             return CFG_MENU
         elif txt.startswith("2"):
             chat_id = update.effective_chat.id
-            user_id = self.session_by_chat.get(chat_id)
+            user_id = self.sessions.user_for_chat(chat_id)
             if not user_id:
                 await update.message.reply_text("⚠️ Session not verified. Use /start.")
                 return ASK_PHONE
             try:
-                user = self.cat.get_user(user_id) or {}
+                user = self._get_user_cached(user_id) or {}
                 channel = user.get("thingspeak_info", {}).get("channel")
                 if not channel:
                     await update.message.reply_text("⚠️ No ThingSpeak channel in Catalog.")
@@ -273,7 +349,7 @@ class TelegramBotService:
             await update.message.reply_text("❌ Invalid time. Example: `22:45`")
             return CFG_TIME_SLEEP
 
-        user_id = self.session_by_chat.get(chat_id)
+        user_id = self.sessions.user_for_chat(chat_id)
         if not user_id:
             await update.message.reply_text("⚠️ Session not verified. Use /start.")
             return ASK_PHONE
@@ -282,18 +358,21 @@ class TelegramBotService:
         times["timesleep"] = s
 
         try:
-            user = self.cat.get_user(user_id) or {}
+            user = self._get_user_cached(user_id) or {}
             info = user.get("user_information", {}) or {}
             info["timeawake"] = times.get("timeawake")
             info["timesleep"] = times.get("timesleep")
             self.cat.patch_user(user_id, {"user_information": info})
+            self._invalidate_user(user_id)
             # Publish initTimeshift event
             room_id = user.get("roomID") or "{Room}"
             topic = f"SC/{user_id}/{room_id}/initTimeshift"
             payload = {"timeawake": info.get("timeawake"), "timesleep": info.get("timesleep")}
             try:
-                self.mqtt_pub.publish(topic, json.dumps(payload), qos=1, retain=False)
-                log.info("MQTT PUB initTimeshift %s -> %s", topic, payload)
+                self.mqtt_pub.publish(topic, orjson.dumps(payload), qos=1, retain=False)
+                # Guarded: skips the payload dict repr when DEBUG is off
+                if log.isEnabledFor(logging.DEBUG):
+                    log.debug("MQTT PUB initTimeshift %s -> %s", topic, payload)
             except Exception:
                 log.exception("MQTT publish initTimeshift failed")
             await update.message.reply_text("✅ Times updated in Catalog.", reply_markup=CFG_KB)
@@ -343,13 +422,13 @@ class TelegramBotService:
         vals = self.tmp.setdefault(chat_id, {})
         vals["hum_high"] = float(s)
 
-        user_id = self.session_by_chat.get(chat_id)
+        user_id = self.sessions.user_for_chat(chat_id)
         if not user_id:
             await update.message.reply_text("⚠️ Session not verified. Use /start.")
             return ASK_PHONE
 
         try:
-            user = self.cat.get_user(user_id) or {}
+            user = self._get_user_cached(user_id) or {}
             thr = user.get("threshold_parameters", {}) or {}
             thr.update({
                 "temp_low": vals["temp_low"],
@@ -358,6 +437,7 @@ class TelegramBotService:
                 "hum_high": vals["hum_high"],
             })
             self.cat.patch_user(user_id, {"threshold_parameters": thr})
+            self._invalidate_user(user_id)
             await update.message.reply_text("✅ Temp/Humidity thresholds updated in Catalog.", reply_markup=CFG_KB)
         except Exception:
             log.exception("patch_user thresholds")
@@ -370,11 +450,24 @@ class TelegramBotService:
 
 # ---------------- MQTT Alerts + TimeShift Listener ----------------
 # ---------------- MQTT Alerts Listener ----------------
+@dataclass(slots=True)
+class AlertState:
+    """Per-(user, room, leaf) alert bookkeeping; slots keep it one fixed-offset
+    attribute load per field instead of a dict per key."""
+    last_status: Optional[str] = None
+    # Pending resend timer while the key stays in ALERT; canceled on OK.
+    timer: Optional[asyncio.TimerHandle] = None
+
+
 class AlertsMQTT:
     """
-    Background MQTT listener that subscribes to alerts *and* bedtime/wakeup topics
+    MQTT listener that subscribes to alerts *and* bedtime/wakeup topics
     and forwards messages to verified chats.
 
+    Runs as an aiomqtt task on the PTB event loop: messages are consumed
+    with ``async for`` and sends await the pooled Telegram client directly,
+    with no listener thread and no cross-thread dispatch.
+
     - Alerts:
         * send on transition to ALERT (previous != ALERT)
         * and every 120s while staying in ALERT
@@ -382,20 +475,39 @@ class AlertsMQTT:
     - Bedtime/Wakeup:
         * send once whenever a message arrives (TimeShift publishes only on transition)
     """
+    __slots__ = ("svc", "host", "port", "subs", "state",
+                 "_send_sem", "_sub_list")
+
     RESEND_SECONDS = 120  # 2 minutes
 
+    # Constant per leaf — built once at class level, returned by reference
+    _BEDTIME_MSG = ("😴 It's time to sleep.\n"
+                    "Please get ready. From now on, sensors and sleep monitoring are active.\n"
+                    "Have a good night! 🌙")
+    _WAKEUP_MSG = ("⏰ Time to wake up!\n"
+                   "Monitoring has been deactivated. Check your dashboard for stats and analysis of your sleep.\n"
+                   "Have a great day! ☀️")
+
+    # Compiled once: one C-level match replaces the split()/len() chain per message
+    _SLEEP_RE = re.compile(r"^SC/([^/]+)/([^/]+)/(bedtime|wakeup)$")
+    _ALERT_RE = re.compile(r"^SC/alerts/([^/]+)/([^/]+)/([^/]+)")
+
     def __init__(self, svc):
         self.svc = svc
         self.host = svc.S.broker_ip
         self.port = svc.S.broker_port
         self.subs = svc.S.mqtt_subs or []
-        self.client = MqttClient(client_id="telegram-bot-alerts", clean_session=True)
-        self.thread: Optional[threading.Thread] = None
 
-        # key: (user, room, leaf) -> {"last_status": str|None, "last_sent": float|0}
-        # Used for alerts only.
-        self.state: Dict[tuple, Dict[str, Any]] = {}
-        self._lock = threading.Lock()
+        # key: (user, room, leaf) -> AlertState. Only touched from the
+        # listener task on the event loop, so no lock needed.
+        self.state: Dict[tuple, AlertState] = {}
+
+        # Bound concurrent sends to respect Telegram's ~30 msg/s global limit
+        self._send_sem = asyncio.Semaphore(30)
+
+        # Built once: the subscription list is constant for the process
+        # lifetime, so reconnects reuse it instead of rebuilding it.
+        self._sub_list = [(t, 1) for t in self._normalized_subs()]
 
     def _normalized_subs(self) -> List[str]:
         out = set(self.subs)
@@ -406,94 +518,103 @@ class AlertsMQTT:
         out.add("SC/+/+/wakeup")
         return list(out)
 
-    # ---- MQTT callbacks ----
-    def on_connect(self, client, userdata, flags, rc):
-        if rc == 0:
-            log.info("MQTT connected to %s:%s", self.host, self.port)
-            for t in self._normalized_subs():
-                try:
-                    client.subscribe(t, qos=1)
-                    log.info("MQTT SUB %s", t)
-                except Exception:
-                    log.exception("MQTT subscribe failed: %s", t)
-        else:
-            log.error("MQTT connection failed rc=%s", rc)
+    # ---- Listener task ----
+    async def run(self):
+        """Consume MQTT messages on the PTB event loop, reconnecting on error."""
+        while True:
+            try:
+                async with aiomqtt.Client(
+                        self.host, self.port,
+                        identifier="telegram-bot-alerts",
+                        keepalive=30) as client:
+                    log.info("MQTT connected to %s:%s", self.host, self.port)
+                    # One SUBSCRIBE packet / one SUBACK for all filters
+                    await client.subscribe(self._sub_list)
+                    async for msg in client.messages:
+                        try:
+                            await self._handle(str(msg.topic), msg.payload)
+                        except Exception:
+                            log.exception("alert message handling failed")
+            except aiomqtt.MqttError as e:
+                log.warning("MQTT connection lost (%s); reconnecting in 5s", e)
+                await asyncio.sleep(5)
+
+    async def _handle(self, topic: str, raw: bytes):
+        # topic e.g. SC/alerts/{User1}/{Room1}/hr  OR  SC/{User1}/{Room1}/bedtime
+
+        # --- Bedtime / Wakeup handling ---
+        m = self._SLEEP_RE.match(topic)
+        if m:
+            user_id, room_id, leaf = m.groups()
+            chats = self._chats_snapshot(user_id)
+            if not chats:
+                return
+            text = self._format_sleep_text(leaf, user_id, room_id)
+            await self._send_to_chats(chats, text)
+            return
+
+        # --- Alerts handling (previous logic) ---
+        m = self._ALERT_RE.match(topic)
+        if m:
+            user_id, room_id, leaf = m.groups()
+            # No verified chats (idle users, the common case): return before
+            # paying for payload decode/parse at all.
+            chats = self._chats_snapshot(user_id)
+            if not chats:
+                return
 
-    def on_message(self, client, userdata, msg: MQTTMessage):
-        try:
-            topic = msg.topic  # e.g. SC/alerts/{User1}/{Room1}/hr  OR  SC/{User1}/{Room1}/bedtime
-            payload = msg.payload.decode("utf-8", errors="ignore")
-            parts = topic.split("/")
+            # Parse once (orjson takes the raw bytes, skipping the decode);
+            # _extract_status and _format_alert_text reuse the dict. The
+            # helpers only decode the bytes on their fallback paths.
+            try:
+                obj = orjson.loads(raw)
+            except Exception:
+                obj = None
 
-            if len(parts) < 3 or parts[0] != "SC":
+            status = self._extract_status(leaf, obj, raw)
+            if status is None:
                 return
 
-            # --- Bedtime / Wakeup handling ---
-            if len(parts) == 4 and parts[2] and parts[3] in ("bedtime", "wakeup"):
-                user_id, room_id, leaf = parts[1], parts[2], parts[3]
-                chats = self.svc.chats_by_user.get(user_id, set())
-                if not chats:
-                    return
-                text = self._format_sleep_text(leaf, user_id, room_id)
-                for chat_id in list(chats):
-                    self._send_to_chat_sync(chat_id, text)
+            key = (user_id, room_id, leaf)
+            st = self.state.get(key)
+            if st is None:
+                st = self.state[key] = AlertState()
+
+            if status != "ALERT":
+                # Leaving ALERT: cancel the pending resend, nothing to send.
+                st.last_status = status
+                if st.timer is not None:
+                    st.timer.cancel()
+                    st.timer = None
                 return
 
-            # --- Alerts handling (previous logic) ---
-            if len(parts) >= 5 and parts[1] == "alerts":
-                user_id, room_id, leaf = parts[2], parts[3], parts[4]
-                chats = self.svc.chats_by_user.get(user_id, set())
-                if not chats:
-                    return
-
-                status = self._extract_status(leaf, payload)
-                if status is None:
-                    return
-
-                key = (user_id, room_id, leaf)
-                now = time.time()
-
-                with self._lock:
-                    st = self.state.get(key, {"last_status": None, "last_sent": 0.0})
-                    last_status = st.get("last_status")
-                    last_sent = float(st.get("last_sent") or 0.0)
-
-                    should_send = False
-                    if status == "ALERT":
-                        if last_status != "ALERT":
-                            should_send = True
-                        elif (now - last_sent) >= self.RESEND_SECONDS:
-                            should_send = True
-                    else:
-                        should_send = False
-
-                    st["last_status"] = status
-                    if should_send:
-                        st["last_sent"] = now
-                    self.state[key] = st
-
-                if should_send:
-                    text = self._format_alert_text(leaf, payload, topic, user_id, room_id)
-                    if not text:
-                        return
-                    for chat_id in list(chats):
-                        self._send_to_chat_sync(chat_id, text)
+            if st.last_status == "ALERT":
+                # Staying in ALERT: the scheduled timer handles resends, so
+                # in-alert messages cost nothing here.
+                return
 
-        except Exception:
-            log.exception("on_message error")
+            st.last_status = "ALERT"
+            text = self._format_alert_text(leaf, obj, raw, topic, user_id, room_id)
+            if not text:
+                return
+            await self._send_to_chats(chats, text)
+            st.timer = asyncio.get_running_loop().call_later(
+                self.RESEND_SECONDS, self._resend, key, user_id, text)
 
     # ---- Helpers ----
+    def _chats_snapshot(self, user_id: str) -> List[int]:
+        """Stable list copy of the user's verified chats."""
+        chats = self.svc.sessions.chats_for_user(user_id)
+        return list(chats) if chats else []
+
     @staticmethod
-    def _extract_status(leaf: str, payload: str) -> Optional[str]:
+    def _extract_status(leaf: str, obj: Optional[dict], raw: bytes) -> Optional[str]:
         """
-        Extract status from payload. Returns "ALERT", "OK", or None if unknown.
-        (Same as before)
+        Extract status from the pre-parsed payload (obj is None if the payload
+        was not valid JSON). Returns "ALERT", "OK", or None if unknown.
+        The fallback substring scans run on the raw bytes (C-level search),
+        so malformed payloads never pay for a UTF-8 decode.
         """
-        try:
-            obj = json.loads(payload)
-        except Exception:
-            obj = None
-
         if leaf == "hr":
             if isinstance(obj, dict):
                 status = obj.get("status") or (obj.get("event") or {}).get("status")
@@ -501,9 +622,9 @@ class AlertsMQTT:
                     status_up = status.strip().upper()
                     if status_up in ("ALERT", "OK"):
                         return status_up
-            if '"status":"ALERT"' in payload:
+            if b'"status":"ALERT"' in raw:
                 return "ALERT"
-            if '"status":"OK"' in payload:
+            if b'"status":"OK"' in raw:
                 return "OK"
             return None
 
@@ -524,9 +645,9 @@ class AlertsMQTT:
                     return "ALERT"
                 if saw_ok and not saw_alert:
                     return "OK"
-            if '"status":"ALERT"' in payload:
+            if b'"status":"ALERT"' in raw:
                 return "ALERT"
-            if '"status":"OK"' in payload:
+            if b'"status":"OK"' in raw:
                 return "OK"
             return None
 
@@ -536,18 +657,18 @@ class AlertsMQTT:
                 su = s.strip().upper()
                 if su in ("ALERT", "OK"):
                     return su
-        if '"status":"ALERT"' in payload:
+        if b'"status":"ALERT"' in raw:
             return "ALERT"
-        if '"status":"OK"' in payload:
+        if b'"status":"OK"' in raw:
             return "OK"
         return None
 
     @staticmethod
-    def _format_alert_text(leaf: str, payload: str, topic: str, user: str, room: str) -> str:
-        try:
-            obj = json.loads(payload)
-        except Exception:
-            obj = None
+    def _format_alert_text(leaf: str, obj: Optional[dict], raw: bytes,
+                           topic: str, user: str, room: str) -> str:
+        # Decode for every non-dict payload (parse failures AND valid
+        # non-object JSON): the generic fallbacks below interpolate it.
+        payload = None if isinstance(obj, dict) else raw.decode("utf-8", errors="ignore")
 
         if leaf == "hr":
             if isinstance(obj, dict):
@@ -584,39 +705,57 @@ class AlertsMQTT:
             return f"🚨 Alert [{user}/{room}] ({leaf}) — Status: {status}\n{json.dumps(obj, ensure_ascii=False)}"
         return f"🚨 Alert [{user}/{room}] ({leaf})\n{payload}"
 
-    @staticmethod
-    def _format_sleep_text(leaf: str, user: str, room: str) -> str:
+    def _format_sleep_text(self, leaf: str, user: str, room: str) -> str:
         """Friendly English messages for bedtime/wakeup."""
-        if leaf == "bedtime":
-            return ("😴 It's time to sleep.\n"
-                    "Please get ready. From now on, sensors and sleep monitoring are active.\n"
-                    "Have a good night! 🌙")
-        # wakeup
-        return ("⏰ Time to wake up!\n"
-                "Monitoring has been deactivated. Check your dashboard for stats and analysis of your sleep.\n"
-                "Have a great day! ☀️")
+        return self._BEDTIME_MSG if leaf == "bedtime" else self._WAKEUP_MSG
 
-    def _send_to_chat_sync(self, chat_id: int, text: str):
-        """Send a Telegram message synchronously from the MQTT thread (safe & simple)."""
-        try:
-            url = f"https://api.telegram.org/bot{self.svc.S.telegram_token}/sendMessage"
-            r = requests.post(url, json={"chat_id": chat_id, "text": text}, timeout=8)
-            if r.status_code != 200:
-                log.error("Telegram sendMessage failed %s: %s", r.status_code, r.text)
-        except Exception:
-            log.exception("Telegram sendMessage request error")
+    async def _send_one(self, bot, chat_id: int, text: str):
+        async with self._send_sem:
+            try:
+                await bot.send_message(chat_id=chat_id, text=text)
+            except Exception:
+                log.exception("Telegram send_message failed for chat %s", chat_id)
 
-    def start(self):
-        self.client.on_connect = self.on_connect
-        self.client.on_message = self.on_message
-        self.client.connect(self.host, self.port, keepalive=30)
-        self.thread = threading.Thread(target=self.client.loop_forever, daemon=True)
-        self.thread.start()
-        log.info("MQTT loop thread started.")
+    async def _send_to_chats(self, chats: List[int], text: str):
+        """Fan out one message to N chats concurrently.
+
+        Every send goes through PTB's persistent HTTPX pool (and its rate
+        limiter when installed); we already run on the PTB loop, so the
+        sends are awaited in place.
+        """
+        bot = self.svc.application.bot
+        await asyncio.gather(
+            *(self._send_one(bot, cid, text) for cid in chats),
+            return_exceptions=True)
+
+    def _resend(self, key: tuple, user_id: str, text: str):
+        """call_later callback: repeat the alert while the key stays in ALERT.
+
+        Fires once per RESEND_SECONDS instead of comparing timestamps on
+        every in-alert message.
+        """
+        st = self.state.get(key)
+        if st is None or st.last_status != "ALERT":
+            return
+        chats = self._chats_snapshot(user_id)
+        if chats:
+            self.svc.application.create_task(self._send_to_chats(chats, text))
+        st.timer = asyncio.get_running_loop().call_later(
+            self.RESEND_SECONDS, self._resend, key, user_id, text)
 
 # ---------------- Bootstrap ----------------
-def build_app(bot: TelegramBotService):
-    app = ApplicationBuilder().token(bot.S.telegram_token).build()
+def build_app(bot: TelegramBotService, alerts: "AlertsMQTT"):
+    async def _post_init(application):
+        # Start the MQTT listener as a task on the PTB event loop; every
+        # message it receives is handled by the same loop that owns the
+        # pooled HTTP client, with no thread in between.
+        application.create_task(alerts.run())
+
+    builder = ApplicationBuilder().token(bot.S.telegram_token).post_init(_post_init)
+    if AIORateLimiter is not None:
+        # Stay just under Telegram's 30 msg/s global cap
+        builder = builder.rate_limiter(AIORateLimiter(overall_max_rate=28, overall_time_period=1))
+    app = builder.build()
     bot.application = app  # expose to MQTT listener
 
     conv = ConversationHandler(
@@ -643,10 +782,8 @@ def build_app(bot: TelegramBotService):
 if __name__ == "__main__":
     S = BotSettings.load("settings.json")
     service = TelegramBotService(S)
-    application = build_app(service)
-
     alerts = AlertsMQTT(service)
-    alerts.start()
+    application = build_app(service, alerts)
 
     log.info("TelegramBot started. Listening for alerts, bedtime/wakeup and user commands.")
     application.run_polling(close_loop=False)
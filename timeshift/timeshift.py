@@ -1,13 +1,22 @@
 import os
 import time
 import json
+import heapq
+import functools
 import logging
+import random
+import socket
 import threading
-from dataclasses import dataclass
-from typing import Dict, Tuple, Any, List, Optional
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from types import MappingProxyType
+from typing import Dict, Mapping, Tuple, Any, List, Optional
 from datetime import datetime
 
-from paho.mqtt.client import Client as MqttClient, MQTTMessage
+import re
+
+import orjson
+from paho.mqtt.client import Client as MqttClient, MQTTMessage, MQTT_ERR_SUCCESS
 from common.catalog_client import CatalogClient
 
 try:
@@ -23,24 +32,28 @@ logging.basicConfig(
 log = logging.getLogger("timeshift")
 
 # --------------- Settings ---------------
-@dataclass
+# frozen+slots: settings are read-only after load, so attribute access goes
+# through slot descriptors and accidental mutation raises.
+@dataclass(frozen=True, slots=True)
 class TSSettings:
     catalog_url: str    # e.g. http://catalog:9080
     broker_ip: str
     broker_port: int
     service_id: str
-    mqtt_pub: Dict[str, str]
-    mqtt_sub: Dict[str, str]
+    mqtt_pub: Mapping[str, str]
+    mqtt_sub: Mapping[str, str]
 
     loop_interval_sec: int = 10
     wake_alarm_seconds: int = 30
     light_threshold_fallback: int = 2048
     timezone: str = "Europe/Rome"
+    times_cache_ttl_sec: int = 300
+    legacy_state_topics: bool = True
 
     @classmethod
     def load(cls, path: str = "settings.json") -> "TSSettings":
-        with open(path, "r", encoding="utf-8") as f:
-            data = json.load(f)
+        with open(path, "rb") as f:
+            data = orjson.loads(f.read())
         si = data["serviceInfo"]
         base = data["catalogURL"].rstrip("/")
         if base.endswith("/catalog"):
@@ -50,12 +63,14 @@ class TSSettings:
             broker_ip=data["brokerIP"],
             broker_port=int(data["brokerPort"]),
             service_id=si.get("serviceID", "TimeShift"),
-            mqtt_pub=dict(si.get("MQTT_pub", {})),
-            mqtt_sub=dict(si.get("MQTT_sub", {})),
+            mqtt_pub=MappingProxyType(dict(si.get("MQTT_pub", {}))),
+            mqtt_sub=MappingProxyType(dict(si.get("MQTT_sub", {}))),
             loop_interval_sec=int(data.get("loop_interval_sec", 10)),
             wake_alarm_seconds=int(data.get("wake_alarm_seconds", 30)),
             light_threshold_fallback=int(data.get("light_threshold_fallback", 2048)),
             timezone=data.get("timezone", "Europe/Rome"),
+            times_cache_ttl_sec=int(data.get("times_cache_ttl_sec", 300)),
+            legacy_state_topics=bool(data.get("legacy_state_topics", True)),
         )
 
 # --------------- Helpers ---------------
@@ -72,33 +87,78 @@ def parse_hhmm(s: str) -> Optional[int]:
     return None
 
 def in_sleep_window(now_min: int, sleep_min: int, wake_min: int) -> bool:
+    # Pure int math; the caller snapshots now_min once per pass. One modular
+    # comparison covers both window orientations: night iff now's offset from
+    # sleep is inside the (possibly midnight-wrapping) window length.
+    # sleep == wake degenerates to a full-day window, as before.
     if sleep_min is None or wake_min is None:
         return False
-    if sleep_min < wake_min:
-        return sleep_min <= now_min < wake_min
-    else:
-        return now_min >= sleep_min or now_min < wake_min
-
-def senml_led_payload(on: bool) -> str:
-    return json.dumps([{
-        "bn": "stateLed",
-        "bt": 0,
-        "e": [{"n":"LedL","u":"bool","vb": bool(on)}]
-    }])
-
+    return (now_min - sleep_min) % 1440 < (((wake_min - sleep_min) % 1440) or 1440)
+
+# Only two possible payloads each — serialized once at import, published as
+# bytes so paho skips the per-publish encode as well.
+_LED_ON = orjson.dumps([{
+    "bn": "stateLed",
+    "bt": 0,
+    "e": [{"n":"LedL","u":"bool","vb": True}]
+}])
+_LED_OFF = orjson.dumps([{
+    "bn": "stateLed",
+    "bt": 0,
+    "e": [{"n":"LedL","u":"bool","vb": False}]
+}])
+_SAMPLING_TRUE = b'{"enable": true}'
+_SAMPLING_FALSE = b'{"enable": false}'
+
+# Fast path for the fixed-shape Light SenML payload: pull the "raw" value
+# straight from the bytes, fall back to a full JSON parse on mismatch.
+_RAW_RE = re.compile(rb'"n"\s*:\s*"raw"[^}]*?"v"\s*:\s*(-?\d+(?:\.\d+)?)')
+
+def senml_led_payload(on: bool) -> bytes:
+    return _LED_ON if on else _LED_OFF
+
+@functools.lru_cache(maxsize=512)
 def canon_id(s: str) -> str:
+    # The user/room id space is small and static, so each string is
+    # canonicalized once and the hot loop pays a dict lookup.
     s = str(s or "")
     return s if (s.startswith("{") and s.endswith("}")) else "{"+s+"}"
 
+@dataclass(slots=True)
+class PairState:
+    """All per-(user, room) state in one slotted struct: one dict entry and
+    one key tuple per pair instead of parallel dicts keyed by the same tuple."""
+    last_light: Optional[int] = None
+    last_phase: Optional[str] = None
+    last_transition_ts: float = 0.0       # monotonic ts of last burst
+    topics: Dict[str, str] = field(default_factory=dict)
+
 # --------------- TimeShift core ---------------
 class TimeShiftService:
+    # Minimum spacing between transition bursts for the same pair
+    TRANSITION_DEBOUNCE_SEC = 30.0
+
     def __init__(self, settings: TSSettings):
         self.S = settings
         self.cat = CatalogClient(self.S.catalog_url)
 
-        self.last_light: Dict[Tuple[str,str], int] = {}
-        self.last_phase: Dict[Tuple[str,str], str] = {}
-        self.known_pairs: set[Tuple[str,str]] = set()
+        # Insertion-ordered registry of discovered pairs; each entry folds
+        # light, phase, debounce and topic state into one PairState, so
+        # membership and per-pair lookups share a single hash probe.
+        self.pairs: Dict[Tuple[str,str], PairState] = {}
+
+        # user -> (timesleep_min, timeawake_min, cached_at). Steady-state ticks
+        # read from here; entries expire after times_cache_ttl_sec or when a
+        # catalog/<user>/updated event arrives, so the loop makes no HTTP
+        # calls unless something actually changed.
+        self._user_times_cache: Dict[str, Tuple[Optional[int], Optional[int], float]] = {}
+
+        # user -> (cached_at, thresholds). Pre-warmed by the background
+        # refresher so light_needs_led is a dict lookup; the TTL outlives
+        # the refresh interval and only matters for brand-new users.
+        self._thr_cache: Dict[str, Tuple[float, dict]] = {}
+        self._thr_cache_ttl = 180.0
+        self._thr_refresh_sec = 60.0
 
         self.light_min = 0
         self.light_max = self.S.light_threshold_fallback * 2  # ~4096
@@ -113,16 +173,94 @@ class TimeShiftService:
         else:
             self.tz = None
 
+        # Cached UTC offset (seconds); refreshed hourly so DST flips are
+        # picked up without building a datetime per user per tick.
+        self._tz_offset = 0.0
+        self._tz_offset_at = 0.0
+
         self.mqtt = MqttClient(client_id="timeshift", clean_session=True)
         self.mqtt.on_connect = self.on_connect
         self.mqtt.on_message = self.on_message
+        self.mqtt.on_publish = self._on_publish_cb
+
+        # MIDs of QoS1 publishes the broker has not acked yet. Publishes are
+        # fire-and-forget; flush() drains this on shutdown.
+        self._pending_mids: set = set()
+        self._mid_lock = threading.Lock()
+        self._mids_drained = threading.Condition(self._mid_lock)
+
+        # Normalized once: reconnects reuse the list and one SUBSCRIBE
+        # packet carries every filter.
+        base_topics = list(self.S.mqtt_sub.values()) if self.S.mqtt_sub else []
+        if not base_topics:
+            base_topics = ["SC/+/+/Light"]
+        # Catalog change notifications: lets the loop run from cache
+        # instead of re-fetching user times every tick.
+        base_topics += ["catalog/+/updated", "catalog/users/+/updated"]
+        self._sub_list = [(self._normalize_sub(t), 1) for t in base_topics]
 
-        self._thread: Optional[threading.Thread] = None
         self._stop = threading.Event()
 
+        # Event-driven scheduler state: min-heap of (epoch deadline, pair)
+        # for upcoming timesleep/timeawake boundaries. The loop sleeps until
+        # the earliest deadline; _sched_wake cuts the sleep short when
+        # membership or user times change. The fallback rescan bounds how
+        # long a stale deadline can survive a missed wake-up.
+        self._sched_heap: List[Tuple[float, Tuple[str, str]]] = []
+        self._sched_lock = threading.Lock()
+        self._sched_wake = threading.Event()
+        self._rescan_sec = float(max(60, self.S.times_cache_ttl_sec))
+
+        # (user, room, kind) -> last published state value. Retained state
+        # topics are skipped when unchanged; events always publish.
+        self._last_state: Dict[Tuple[str,str,str], Any] = {}
+
+        # Evaluates pairs concurrently: cache misses block on catalog HTTP,
+        # so serial ticks cost O(N_users x RTT) otherwise. Together with the
+        # pooled CatalogClient session this gives O(max rtt) ticks without
+        # moving the service onto an asyncio stack.
+        self._exec = ThreadPoolExecutor(max_workers=8, thread_name_prefix="ts-eval")
+        self._phase_lock = threading.Lock()
+
+        # Restart safety: without this, every restart treats the current
+        # phase as a fresh transition and replays the full publish burst.
+        self._phase_file = "timeshift_phase.json"
+        self._load_phase_state()
+
         # Best-effort: update service entry in Catalog
         self._upsert_service()
 
+    # ---------- Phase persistence ----------
+    def _load_phase_state(self):
+        try:
+            with open(self._phase_file, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            for k, v in data.items():
+                key = tuple(k.split("|", 1))
+                self._register_pair(*key)
+                self.pairs[key].last_phase = v
+            log.info("Restored %d phase entries from %s", len(data), self._phase_file)
+        except FileNotFoundError:
+            pass
+        except Exception:
+            log.exception("Could not load phase state from %s", self._phase_file)
+
+    def _save_phase_state(self):
+        try:
+            # Write + replace stay under the lock: concurrent transitions on
+            # the evaluation pool would otherwise interleave writes to the
+            # same tmp path and replace with truncated JSON. Cold path, so
+            # briefly serializing savers is fine.
+            with self._phase_lock:
+                data = {"|".join(k): st.last_phase
+                        for k, st in self.pairs.items() if st.last_phase is not None}
+                tmp = self._phase_file + ".tmp"
+                with open(tmp, "w", encoding="utf-8") as f:
+                    json.dump(data, f)
+                os.replace(tmp, self._phase_file)  # atomic on POSIX
+        except Exception:
+            log.exception("Could not persist phase state to %s", self._phase_file)
+
     # ---------- Catalog ----------
     def _load_thresholds(self):
         """
@@ -134,100 +272,214 @@ class TimeShiftService:
         log.info("Thresholds (fallback) pot_min=%s pot_max=%s", self.light_min, self.light_max)
 
     def _target_pairs(self) -> List[Tuple[str,str]]:
-        # No bulk fetch; use pairs discovered via incoming Light messages
-        return list(self.known_pairs)
+        # No bulk fetch; use pairs discovered via incoming Light messages.
+        # Entries are stored already canonicalized, so downstream canon_id
+        # calls hit the lru_cache.
+        return list(self.pairs)
 
     def _user_times(self, user_id: str) -> Tuple[Optional[int], Optional[int]]:
+        hit = self._user_times_cache.get(user_id)
+        if hit is not None and time.monotonic() - hit[2] < self.S.times_cache_ttl_sec:
+            return hit[0], hit[1]
         try:
             u = self.cat.get_user(user_id) or {}
             info = u.get("user_information", {}) or {}
             ts = parse_hhmm(info.get("timesleep"))
             ta = parse_hhmm(info.get("timeawake"))
+            self._user_times_cache[user_id] = (ts, ta, time.monotonic())
             return ts, ta
         except Exception:
             log.exception("Error leyendo times para user %s", user_id)
             return None, None
 
+    def _user_thresholds_cached(self, user_id: str) -> dict:
+        hit = self._thr_cache.get(user_id)
+        if hit is not None and time.monotonic() - hit[0] < self._thr_cache_ttl:
+            return hit[1]
+        try:
+            thr = self.cat.user_thresholds(user_id)
+        except Exception:
+            self._thr_cache.pop(user_id, None)
+            log.exception("Error fetching thresholds for user %s", user_id)
+            return {}
+        self._thr_cache[user_id] = (time.monotonic(), thr)
+        return thr
+
+    def _refresh_user(self, uid: str):
+        """One GET re-warms both the thresholds and sleep/wake times caches
+        for a user. Swallows errors so one bad user can't stop a batch."""
+        try:
+            u = self.cat.get_user(uid) or {}
+            now_mono = time.monotonic()
+            self._thr_cache[uid] = (now_mono, u.get("threshold_parameters") or {})
+            info = u.get("user_information", {}) or {}
+            self._user_times_cache[uid] = (
+                parse_hhmm(info.get("timesleep")),
+                parse_hhmm(info.get("timeawake")),
+                now_mono)
+        except Exception:
+            log.exception("user refresh failed for %s", uid)
+
+    def _threshold_refresher(self):
+        """Background loop: fans the per-user refreshes out on the shared
+        executor, so a batch costs one RTT instead of len(users) serial
+        RTTs (the pooled session reuses its keep-alive sockets). Jittered
+        to avoid syncing with other services' polling."""
+        while not self._stop.is_set():
+            try:
+                uids = {u for u, _ in self._target_pairs()}
+                if uids:
+                    # list() drains the iterator so exceptions surface here
+                    list(self._exec.map(self._refresh_user, uids))
+            except Exception:
+                log.exception("user refresher error")
+            self._stop.wait(self._thr_refresh_sec + random.uniform(0.0, 5.0))
+
+    def _invalidate_user_times(self, user_id: str):
+        """Drop cached times for a user (both raw and canonical keys)."""
+        for key in (user_id, canon_id(user_id)):
+            self._user_times_cache.pop(key, None)
+            self._thr_cache.pop(key, None)
+        # Changed times move the user's boundaries: recompute the heap.
+        self._sched_wake.set()
+
+    def _user_from_snapshot(self, user_id: str) -> Optional[dict]:
+        """Look a user up in the cached /catalog snapshot (one round-trip
+        serves users and rooms; ids match with or without braces)."""
+        try:
+            snap = self.cat.snapshot()
+        except Exception:
+            return None
+        want = {user_id, canon_id(user_id), str(user_id).strip("{}")}
+        for u in snap.get("usersList", []) or []:
+            if str(u.get("userID", "")) in want:
+                return u
+        return None
+
     # ---------- MQTT ----------
+    def _tune_socket(self):
+        """Disable Nagle and widen the send buffer on the broker socket.
+
+        The bedtime/wakeup bursts are several small packets back to back;
+        without TCP_NODELAY the Nagle/delayed-ACK interaction can hold the
+        second one for tens of milliseconds.
+        """
+        try:
+            sock = self.mqtt.socket()
+            if sock is not None:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 65536)
+        except Exception:
+            log.exception("socket tuning failed")
+
     def connect_mqtt(self):
+        self.mqtt.max_inflight_messages_set(20)
+        # Bound paho's outbound queue: with a slow/absent broker it buffers
+        # indefinitely otherwise. Past the cap publish() returns
+        # MQTT_ERR_QUEUE_SIZE and the message is dropped (see _pub).
+        self.mqtt.max_queued_messages_set(1000)
         self.mqtt.connect(self.S.broker_ip, self.S.broker_port, keepalive=30)
-        self._thread = threading.Thread(target=self.mqtt.loop_forever, daemon=True)
-        self._thread.start()
-        log.info("MQTT loop thread started.")
+        self._tune_socket()
+        self.mqtt.loop_start()  # paho-managed network thread
+        log.info("MQTT network loop started.")
 
     def on_connect(self, client, userdata, flags, rc):
         if rc != 0:
             log.error("MQTT connect rc=%s", rc); return
+        # Re-apply on every (re)connect: paho creates a fresh socket each time
+        self._tune_socket()
         try:
-            topics = list(self.S.mqtt_sub.values()) if self.S.mqtt_sub else []
-            if not topics:
-                topics = ["SC/+/+/Light"]
-            for t in topics:
-                sub = self._normalize_sub(t)
-                client.subscribe(sub, qos=1)
-                log.info("SUB %s (from %s)", sub, t)
+            # One SUBSCRIBE packet / one SUBACK for all filters
+            client.subscribe(self._sub_list)
+            log.info("SUB %s", [t for t, _ in self._sub_list])
         except Exception:
             log.exception("subscribe topics failed")
 
     def on_message(self, client, userdata, msg: MQTTMessage):
+        """Runs on the paho network thread: classify the topic, do only the
+        cheap dict work inline, and hand anything that may hit the catalog
+        to the worker pool so packet processing never stalls on HTTP."""
         try:
             topic = msg.topic  # SC/<user>/<room>/Light
             parts = topic.split("/")
-            if len(parts) == 4 and parts[0] == "SC" and parts[3] == "Light":
+            if parts[0] == "catalog" and parts[-1] == "updated" and len(parts) in (3, 4):
+                # catalog/<user>/updated or catalog/users/<user>/updated:
+                # drop the cache entry so the next tick re-fetches.
+                self._invalidate_user_times(parts[-2])
+                log.info("[catalog] times cache invalidated for user=%s", parts[-2])
+                return
+            if len(parts) == 4 and parts[0] == "SC" and parts[3] in ("Light", "initTimeshift"):
+                self._exec.submit(self._handle_message, topic, parts, msg.payload)
+        except Exception:
+            log.exception("on_message error")
+
+    def _handle_message(self, topic: str, parts: List[str], payload: bytes):
+        try:
+            if parts[3] == "Light":
                 user_raw, room_raw = parts[1], parts[2]
                 user, room = canon_id(user_raw), canon_id(room_raw)
-                log.info("[light] msg from user=%s room=%s topic=%s", user, room, topic)
-                # Register pair from topic
-                self.known_pairs.add((user, room))
-
-                # Best-effort: fetch user to get authoritative roomID, then fetch that room
-                try:
-                    u = self.cat.get_user(user_raw) or {}
-                    room_id = u.get("roomID")
-                    if room_id:
-                        room_canon = canon_id(room_id)
-                        self.known_pairs.add((canon_id(user_raw), room_canon))
-                        try:
-                            _ = self.cat.get_room(str(room_id))
-                        except Exception:
-                            pass
-                except Exception:
-                    log.exception("Error fetching user/room for light topic %s", topic)
-
-                raw = self._parse_light_senml(msg.payload.decode("utf-8","ignore"))
+                log.debug("[light] msg from user=%s room=%s topic=%s", user, room, topic)
+                key = (user, room)
+                if key not in self.pairs:
+                    # First sighting only: register and resolve the
+                    # authoritative roomID from the cached catalog snapshot.
+                    # Steady-state samples never touch the catalog; the
+                    # background refresher keeps user state current.
+                    self._register_pair(user, room)
+                    try:
+                        u = self._user_from_snapshot(user_raw) or {}
+                        room_id = u.get("roomID")
+                        if room_id:
+                            self._register_pair(canon_id(user_raw), canon_id(room_id))
+                    except Exception:
+                        log.exception("Error resolving user/room for light topic %s", topic)
+
+                raw = self._parse_light_senml(payload)
                 if raw is not None:
-                    self.last_light[(user,room)] = raw
-                    log.info("[light] cached raw=%s for %s/%s", raw, user, room)
-            elif len(parts) == 4 and parts[0] == "SC" and parts[3] == "initTimeshift":
+                    self.pairs[key].last_light = raw
+                    log.debug("[light] cached raw=%s for %s/%s", raw, user, room)
+            elif parts[3] == "initTimeshift":
                 user_raw, room_raw = parts[1], parts[2]
                 user, room = canon_id(user_raw), canon_id(room_raw)
-                payload_txt = msg.payload.decode("utf-8","ignore")
-                log.info("[initTimeshift] msg user=%s room=%s topic=%s payload=%s", user, room, topic, payload_txt)
-                self.known_pairs.add((user, room))
-                # Best-effort: fetch user/room to ensure they exist
+                if log.isEnabledFor(logging.DEBUG):
+                    log.debug("[initTimeshift] msg user=%s room=%s topic=%s payload=%s",
+                              user, room, topic, payload.decode("utf-8", "ignore"))
+                self._register_pair(user, room)
+                # Times just changed upstream: drop the stale cache entry
+                self._invalidate_user_times(user_raw)
+                # Best-effort: resolve user/room from one catalog snapshot
                 try:
-                    u = self.cat.get_user(user_raw) or {}
+                    u = self._user_from_snapshot(user_raw) or {}
                     room_id = u.get("roomID") or room_raw
                     if room_id:
-                        self.cat.get_room(str(room_id))
-                        self.known_pairs.add((canon_id(user_raw), canon_id(room_id)))
-                    # Seed last_phase with current phase to avoid immediate false transitions
+                        self._register_pair(canon_id(user_raw), canon_id(room_id))
+                    # Seed the stored phase with the current one to avoid immediate false transitions
                     phase, ts, ta = self.desired_phase(user_raw)
                     key = (canon_id(user_raw), canon_id(room_id or room_raw))
                     if phase is not None:
-                        self.last_phase[key] = phase
+                        self.pairs[key].last_phase = phase
+                        self._save_phase_state()
                         log.info("[initTimeshift] registered pair user=%s room=%s phase=%s ts=%s ta=%s", key[0], key[1], phase, ts, ta)
                     else:
                         log.info("[initTimeshift] registered pair user=%s room=%s but missing times", key[0], key[1])
                 except Exception:
                     log.exception("Error processing initTimeshift for %s/%s", user, room)
         except Exception:
-            log.exception("on_message error")
+            log.exception("message handling error for %s", topic)
 
     @staticmethod
-    def _parse_light_senml(payload: str) -> Optional[int]:
+    def _parse_light_senml(payload: bytes) -> Optional[int]:
+        m = _RAW_RE.search(payload)
+        if m is not None:
+            try:
+                g = m.group(1)
+                # ADC readings are integers in practice; skip the float hop
+                return int(g) if b"." not in g else int(float(g))
+            except Exception:
+                pass
         try:
-            arr = json.loads(payload)
+            # orjson parses the raw bytes directly — no UTF-8 decode pass
+            arr = orjson.loads(payload)
             if isinstance(arr, list) and arr:
                 rec = arr[0]
                 e = rec.get("e", [])
@@ -243,21 +495,90 @@ class TimeShiftService:
 
     # ---------- Publish helper ----------
     def _pub(self, topic: str, payload: str | bytes, *, qos: int = 1, retain: bool = False):
+        """Fire-and-forget publish; the broker ack is tracked via on_publish.
+
+        Nothing blocks on the PUBACK round-trip — paho retries QoS1
+        delivery on its own, and flush() can drain the pending set when
+        ordering against shutdown matters.
+        """
         try:
             res = self.mqtt.publish(topic, payload=payload, qos=qos, retain=retain)
-            res.wait_for_publish()
-            log.info("PUB %s (qos=%d retain=%s) -> %s", topic, qos, retain,
-                     payload if isinstance(payload, str) else "<bytes>")
+            if res.rc != MQTT_ERR_SUCCESS:
+                # Queue full or not connected: paho dropped the message, so
+                # no on_publish will fire — don't track the mid.
+                log.warning("Publish rejected rc=%s for %s (queue full?)", res.rc, topic)
+                return res
+            if qos > 0:
+                with self._mid_lock:
+                    self._pending_mids.add(res.mid)
+            log.debug("PUB %s (qos=%d retain=%s, %d bytes)", topic, qos, retain,
+                      len(payload) if isinstance(payload, (bytes, str)) else 0)
+            return res
         except Exception:
             log.exception("Publish failed: %s", topic)
+            return None
+
+    def _on_publish_cb(self, client, userdata, mid):
+        with self._mid_lock:
+            self._pending_mids.discard(mid)
+            if not self._pending_mids:
+                self._mids_drained.notify_all()
+
+    def flush(self, timeout: float = 5.0) -> bool:
+        """Wait (bounded) until every in-flight QoS1 publish is acked."""
+        deadline = time.monotonic() + timeout
+        with self._mid_lock:
+            while self._pending_mids:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._mids_drained.wait(remaining)
+        return True
+
+    def _pub_state(self, user: str, room: str, kind: str, value, payload):
+        """Publish a retained state topic, skipping when unchanged. The
+        value is recorded only after _pub reports a successful enqueue, so
+        a rejected publish (full queue, no connection) is retried on the
+        next transition instead of leaving the retained topic stale."""
+        key = (user, room, kind)
+        if self._last_state.get(key) == value:
+            return None
+        topic = self._topic_for(user, room, kind)
+        res = self._pub(topic, payload, qos=1, retain=True)
+        if res is not None and res.rc == MQTT_ERR_SUCCESS:
+            self._last_state[key] = value
+        return res
 
     # ---------- Publicadores ----------
+    # pub_* expect canonical ids; do_bedtime/do_wakeup and the tick loop
+    # pass them straight from the pairs registry.
     @staticmethod
     def _fmt_topic(template: str, user: str, room: str) -> str:
         return (template
                 .replace("{User}", user)
                 .replace("{Room}", room))
 
+    _TOPIC_KINDS = ("sampling", "bedtime", "wakeup", "LedL", "servoV", "state")
+
+    def _register_pair(self, user: str, room: str):
+        """Record a (canonical) pair and prewarm its publish topics so the
+        transition burst never takes lazy formatting misses."""
+        if (user, room) not in self.pairs:
+            self.pairs[(user, room)] = PairState()
+            for kind in self._TOPIC_KINDS:
+                self._topic_for(user, room, kind)
+            # Wake the scheduler so the new pair is evaluated and armed
+            # now instead of on the next fallback rescan.
+            self._sched_wake.set()
+
+    def _topic_for(self, user: str, room: str, kind: str) -> str:
+        st = self.pairs.setdefault((user, room), PairState())
+        t = st.topics.get(kind)
+        if t is None:
+            tpl = self.S.mqtt_pub.get(kind, "SC/{User}/{Room}/" + kind)
+            t = st.topics[kind] = self._fmt_topic(tpl, user, room)
+        return t
+
     @staticmethod
     def _normalize_sub(template: str) -> str:
         """Replace placeholders with wildcards for subscriptions."""
@@ -267,80 +588,107 @@ class TimeShiftService:
         return t
 
     def pub_sampling(self, user: str, room: str, enable: bool):
-        user, room = canon_id(user), canon_id(room)
-        tpl = self.S.mqtt_pub.get("sampling", "SC/{User}/{Room}/sampling")
-        topic = self._fmt_topic(tpl, user, room)
-        payload = json.dumps({"enable": bool(enable)})
-        self._pub(topic, payload, qos=1, retain=True)   # ESTADO
+        payload = _SAMPLING_TRUE if enable else _SAMPLING_FALSE
+        return self._pub_state(user, room, "sampling", bool(enable), payload)  # ESTADO
 
     def pub_bedtime(self, user: str, room: str):
-        user, room = canon_id(user), canon_id(room)
-        tpl = self.S.mqtt_pub.get("bedtime", "SC/{User}/{Room}/bedtime")
-        topic = self._fmt_topic(tpl, user, room)
-        payload = json.dumps({"ts": int(time.time())})
-        self._pub(topic, payload, qos=1, retain=False)  # EVENTO
+        topic = self._topic_for(user, room, "bedtime")
+        payload = b'{"ts":%d}' % int(time.time())
+        return self._pub(topic, payload, qos=1, retain=False)  # EVENTO
 
     def pub_wakeup(self, user: str, room: str):
-        user, room = canon_id(user), canon_id(room)
-        tpl = self.S.mqtt_pub.get("wakeup", "SC/{User}/{Room}/wakeup")
-        topic = self._fmt_topic(tpl, user, room)
-        payload = json.dumps({"seconds": int(self.S.wake_alarm_seconds)})
-        self._pub(topic, payload, qos=1, retain=False)  # EVENTO
+        topic = self._topic_for(user, room, "wakeup")
+        payload = b'{"seconds":%d}' % int(self.S.wake_alarm_seconds)
+        return self._pub(topic, payload, qos=1, retain=False)  # EVENTO
 
     def pub_led_senml(self, user: str, room: str, on: bool):
-        user, room = canon_id(user), canon_id(room)
-        tpl = self.S.mqtt_pub.get("LedL", "SC/{User}/{Room}/LedL")
-        topic = self._fmt_topic(tpl, user, room)
-        payload = senml_led_payload(on)
-        self._pub(topic, payload, qos=1, retain=True)   # ESTADO
+        return self._pub_state(user, room, "LedL", bool(on), senml_led_payload(on))  # ESTADO
+
+    def pub_state_bundle(self, user: str, room: str, states: Dict[str, Any]):
+        """One retained composite topic per room instead of 3-4 separate
+        retained publishes; subscribers pick the fields they need."""
+        return self._pub_state(user, room, "state", dict(states),
+                               orjson.dumps(states))  # ESTADO
 
     def pub_servo(self, user: str, room: str, deg: int):
-        user, room = canon_id(user), canon_id(room)
-        tpl = self.S.mqtt_pub.get("servoV", "SC/{User}/{Room}/servoV")
-        topic = self._fmt_topic(tpl, user, room)
         payload = str(int(deg))  # "0" ó "90"
-        self._pub(topic, payload, qos=1, retain=True)   # ESTADO
+        return self._pub_state(user, room, "servoV", int(deg), payload)  # ESTADO
 
     # ---------- Lógica principal ----------
-    def desired_phase(self, user: str) -> Tuple[Optional[str], Optional[int], Optional[int]]:
+    def _local_sec(self, now: float) -> float:
+        """Seconds since local midnight, from time.time() plus a cached
+        UTC offset — no datetime allocation on the per-user path."""
+        if self.tz is None:
+            lt = time.localtime(now)
+            return lt.tm_hour * 3600 + lt.tm_min * 60 + lt.tm_sec
+        if now - self._tz_offset_at > 3600:
+            self._tz_offset = self.tz.utcoffset(datetime.now(self.tz)).total_seconds()
+            self._tz_offset_at = now
+        return (now + self._tz_offset) % 86400
+
+    def _now_min(self) -> int:
+        return int(self._local_sec(time.time()) // 60)
+
+    def _next_deadline(self, user: str) -> Optional[float]:
+        """Epoch time of the user's next timesleep/timeawake boundary, or
+        None while the user has no configured times."""
+        ts, ta = self._user_times(user)
+        if ts is None or ta is None:
+            return None
+        now = time.time()
+        day_sec = self._local_sec(now)
+        # Strictly future occurrence of each boundary: a boundary hit right
+        # now has just been evaluated, so its next occurrence is tomorrow.
+        delta = min((((b * 60 - day_sec) % 86400) or 86400.0) for b in (ts, ta))
+        return now + delta
+
+    def desired_phase(self, user: str, now_min: Optional[int] = None) -> Tuple[Optional[str], Optional[int], Optional[int]]:
         ts, ta = self._user_times(user)
         if ts is None or ta is None:
             return None, ts, ta
-        now = datetime.now(self.tz) if self.tz is not None else datetime.now()
-        now_min = now.hour*60 + now.minute
+        if now_min is None:
+            now_min = self._now_min()
         night = in_sleep_window(now_min, ts, ta)
         return ("night" if night else "day"), ts, ta
 
     def light_needs_led(self, user: str, room: str) -> bool:
-        user, room = canon_id(user), canon_id(room)
+        # Callers pass canonical ids (see pub_* note).
         # Per-user thresholds from catalog; fallback to global defaults
-        thr = self.cat.user_thresholds(user)
+        thr = self._user_thresholds_cached(user)
         pot_min = thr.get("pot_min", self.light_min)
         pot_max = thr.get("pot_max", self.light_max)
-        log.info("[thr] user=%s room=%s pot_min=%s pot_max=%s", user, room, pot_min, pot_max)
+        log.debug("[thr] user=%s room=%s pot_min=%s pot_max=%s", user, room, pot_min, pot_max)
 
-        raw = self.last_light.get((user, room))
+        st = self.pairs.get((user, room))
+        raw = st.last_light if st is not None else None
         if raw is None:
-            log.info("No light cached for %s/%s -> LED ON by default", user, room)
+            log.debug("No light cached for %s/%s -> LED ON by default", user, room)
             return True
         thr = (pot_min + pot_max) / 2.0
         need = raw < thr
-        log.info("[decision] light %s/%s raw=%s thr=%.1f below=%s -> LED %s",
-                 user, room, raw, thr, raw < thr, "ON" if need else "OFF")
+        log.debug("[decision] light %s/%s raw=%s thr=%.1f below=%s -> LED %s",
+                  user, room, raw, thr, raw < thr, "ON" if need else "OFF")
         return need
 
     def do_bedtime(self, user: str, room: str):
-        self.pub_bedtime(user, room)          # evento
-        self.pub_sampling(user, room, True)   # estado
-        self.pub_servo(user, room, 0)         # estado
-        self.pub_led_senml(user, room, False) # estado
+        # All publishes are fire-and-forget; acks drain via on_publish.
+        self.pub_bedtime(user, room)   # evento
+        self.pub_state_bundle(user, room,
+                              {"sampling": True, "servoV": 0, "LedL": False})
+        if self.S.legacy_state_topics:  # until all clients read the bundle
+            self.pub_sampling(user, room, True)   # estado
+            self.pub_servo(user, room, 0)         # estado
+            self.pub_led_senml(user, room, False) # estado
 
     def do_wakeup(self, user: str, room: str):
-        self.pub_wakeup(user, room)           # evento
         led_on = self.light_needs_led(user, room)
-        self.pub_led_senml(user, room, led_on) # estado
-        self.pub_servo(user, room, 90)         # estado
-        self.pub_sampling(user, room, False)   # estado
+        self.pub_wakeup(user, room)    # evento
+        self.pub_state_bundle(user, room,
+                              {"sampling": False, "servoV": 90, "LedL": led_on})
+        if self.S.legacy_state_topics:  # until all clients read the bundle
+            self.pub_led_senml(user, room, led_on) # estado
+            self.pub_servo(user, room, 90)         # estado
+            self.pub_sampling(user, room, False)   # estado
 
     def _upsert_service(self):
         mqtt_sub_list = list(self.S.mqtt_sub.values()) if self.S.mqtt_sub else []
@@ -355,40 +703,109 @@ class TimeShiftService:
         except Exception:
             log.exception("Catalog upsert service failed")
 
+    def _evaluate_pair(self, pair: Tuple[str, str], now_min: int):
+        # Registry entries are canonicalized when registered in
+        # on_message, so the ids are used as-is here.
+        user, room = pair
+        st = self.pairs.get(pair)
+        if st is None:
+            return
+        phase, ts, ta = self.desired_phase(user, now_min)
+        if phase is None:
+            return
+
+        # Check-and-set under the lock; the publishes run outside it so one
+        # slow transition doesn't serialize the others.
+        now_mono = time.monotonic()
+        with self._phase_lock:
+            if st.last_phase == phase:
+                return
+            if now_mono - st.last_transition_ts < self.TRANSITION_DEBOUNCE_SEC:
+                return  # flap: re-evaluated on the next pass
+            st.last_phase = phase
+            st.last_transition_ts = now_mono
+
+        if phase == "night":
+            log.info("[%s/%s] Transition -> NIGHT", user, room)
+            self.do_bedtime(user, room)
+        else:
+            log.info("[%s/%s] Transition -> DAY", user, room)
+            self.do_wakeup(user, room)
+        self._save_phase_state()
+
+    def _rescan(self):
+        """Evaluate every known pair and rebuild the deadline heap. Runs at
+        startup, when membership or times change, and on the fallback timer."""
+        pairs = self._target_pairs()
+        if pairs:
+            now_min = self._now_min()  # once per pass, shared by all users
+            # list() drains the iterator so exceptions surface here
+            list(self._exec.map(
+                functools.partial(self._evaluate_pair, now_min=now_min),
+                pairs))
+        entries = [(d, p) for p in pairs
+                   if (d := self._next_deadline(p[0])) is not None]
+        with self._sched_lock:
+            self._sched_heap[:] = entries
+            heapq.heapify(self._sched_heap)
+
+    def _push_deadlines(self, pairs: List[Tuple[str, str]]):
+        """Re-arm the next boundary for pairs that just fired."""
+        entries = [(self._next_deadline(p[0]), p) for p in pairs]
+        with self._sched_lock:
+            for d, p in entries:
+                if d is not None and p in self.pairs:
+                    heapq.heappush(self._sched_heap, (d, p))
+
     def run(self):
         self.connect_mqtt()
-        log.info("TimeShift running every %ss (TZ=%s)", self.S.loop_interval_sec, self.S.timezone)
+        threading.Thread(target=self._threshold_refresher, daemon=True,
+                         name="ts-thr-refresh").start()
+        log.info("TimeShift scheduler: wakes on ts/ta boundaries, rescan every %ss (TZ=%s)",
+                 int(self._rescan_sec), self.S.timezone)
 
+        self._rescan()
         while not self._stop.is_set():
             try:
-                pairs = self._target_pairs()
-                for (user_raw, room_raw) in pairs:
-                    user, room = canon_id(user_raw), canon_id(room_raw)
-                    phase, ts, ta = self.desired_phase(user_raw)
-                    if phase is None:
-                        continue
-
-                    key = (user, room)
-                    last = self.last_phase.get(key)
-
-                    if last != phase:
-                        self.last_phase[key] = phase
-                        if phase == "night":
-                            log.info("[%s/%s] Transition -> NIGHT", user, room)
-                            self.do_bedtime(user, room)
-                        else:
-                            log.info("[%s/%s] Transition -> DAY", user, room)
-                            self.do_wakeup(user, room)
-
-                self._stop.wait(self.S.loop_interval_sec)
+                with self._sched_lock:
+                    deadline = self._sched_heap[0][0] if self._sched_heap else None
+                timeout = self._rescan_sec if deadline is None else \
+                    min(max(deadline - time.time(), 0.0), self._rescan_sec)
+                if timeout > 0:
+                    self._sched_wake.wait(timeout)
+                if self._stop.is_set():
+                    break
+                if self._sched_wake.is_set():
+                    # New pair or changed times: rebuild the heap rather
+                    # than hunt for stale entries in place.
+                    self._sched_wake.clear()
+                    self._rescan()
+                    continue
+
+                due: List[Tuple[str, str]] = []
+                now = time.time()
+                with self._sched_lock:
+                    while self._sched_heap and self._sched_heap[0][0] <= now:
+                        due.append(heapq.heappop(self._sched_heap)[1])
+                if due:
+                    now_min = self._now_min()
+                    list(self._exec.map(
+                        functools.partial(self._evaluate_pair, now_min=now_min),
+                        due))
+                    self._push_deadlines(due)
+                else:
+                    self._rescan()  # fallback expiry: safety pass
 
             except Exception:
-                log.exception("loop error")
+                log.exception("scheduler error")
                 self._stop.wait(self.S.loop_interval_sec)
 
     def stop(self):
         self._stop.set()
+        self._sched_wake.set()  # break the boundary sleep immediately
         try:
+            self.flush()  # drain in-flight QoS1 acks before tearing down
+            self.mqtt.loop_stop()
             self.mqtt.disconnect()
         except Exception:
             pass